@@ -0,0 +1,85 @@
+"""
+Check the scenario CVaR mode of optimize_portfolio against the full Rockafellar-Uryasev linear program,
+solved directly with one row per scenario, on small synthetic problems.
+
+Run with: python check_portfolio_optimisation.py
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.optimize import linprog
+
+from portfolio_optimisation import generate_scenarios, optimize_portfolio, portfolio_cvar
+
+
+def full_cvar_lp(reward, scenarios, probabilities, beta, risk_aversion, target_risk, long_only):
+    """
+    Solve min CVaR - reward.w / risk_aversion (target_risk None) or max reward.w s.t. CVaR <= target_risk
+    over the variables [w, VaR, z], z_s >= -r_s.w - VaR being the loss above the VaR in each scenario.
+
+    Returns the optimal value of the same objective.
+    """
+
+    n_scenarios, n_assets = scenarios.shape
+    losses_rows = sparse.hstack([
+        sparse.csr_matrix(-scenarios.astype(np.float64)),
+        sparse.csr_matrix(-np.ones((n_scenarios, 1))),
+        -sparse.identity(n_scenarios),
+    ])
+    cvar_row = np.concatenate((np.zeros(n_assets), [1.], probabilities / (1 - beta)))
+
+    if target_risk is None:
+        c = cvar_row - np.concatenate((reward / risk_aversion, np.zeros(n_scenarios + 1)))
+        A_ub, b_ub = losses_rows, np.zeros(n_scenarios)
+    else:
+        c = -np.concatenate((reward, np.zeros(n_scenarios + 1)))
+        A_ub = sparse.vstack([losses_rows, sparse.csr_matrix(cvar_row)])
+        b_ub = np.append(np.zeros(n_scenarios), target_risk)
+
+    bounds = [(0 if long_only else -1, 1)] * n_assets + [(None, None)] + [(0, None)] * n_scenarios
+    A_eq = np.concatenate((np.ones(n_assets), np.zeros(n_scenarios + 1)))[None]
+    opt_results = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=[1.], bounds=bounds, method='highs')
+    assert opt_results.success, opt_results.message
+
+    return opt_results.fun
+
+
+def main(n_obs=1000, n_scenarios=3000, n_assets=10, beta=0.95, gamma=1e-4, tol=1e-6):
+    rng = np.random.default_rng(0)
+    returns = pd.DataFrame(rng.standard_t(4, (n_obs, n_assets)) * 0.01 + rng.normal(3e-4, 3e-4, n_assets))
+    expected_returns = returns.mean()
+    weighted_scores = pd.Series(rng.normal(0, 1, n_assets))
+    reward = expected_returns.values + gamma * weighted_scores.values
+
+    cases = [
+        ('historical', 1., None), ('historical', 1., 0.02),
+        ('bootstrap', 1., None), ('bootstrap', 1., 0.02),
+        ('importance', 1., None), ('importance', 1., 0.02),
+        ('importance', 1e-4, None), ('importance', 1e-6, None),
+    ]
+    for method, risk_aversion, target_risk in cases:
+        scenarios, probabilities = generate_scenarios(returns, n_scenarios, method, seed=1)
+        for long_only in (True, False):
+            weights, _, cvar, _ = optimize_portfolio(
+                expected_returns, None, weighted_scores, 1., gamma, target_risk, 0., long_only=long_only,
+                risk_measure='cvar', scenarios=scenarios, probabilities=probabilities, beta=beta,
+                risk_aversion=risk_aversion
+            )
+            assert np.isclose(cvar, portfolio_cvar(weights, scenarios, probabilities, beta)[1])
+
+            expected = full_cvar_lp(reward, scenarios, probabilities, beta, risk_aversion, target_risk, long_only)
+            if target_risk is None:
+                value = cvar - reward @ weights / risk_aversion
+            else:
+                value = -reward @ weights
+                assert cvar <= target_risk * (1 + tol), f"CVaR {cvar} above target_risk {target_risk}"
+            error = abs(value - expected) / max(1., abs(expected))
+
+            print(f"{method:>10} risk_aversion={risk_aversion:<6g} target_risk={target_risk!s:<5} "
+                  f"long_only={long_only!s:<5} value={value:.9g} full LP={expected:.9g} error={error:.1e}")
+            assert error <= tol, f"{method} differs from the full LP by {error}"
+
+
+if __name__ == '__main__':
+    main()
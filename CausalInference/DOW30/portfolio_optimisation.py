@@ -1,8 +1,28 @@
 import pandas as pd
 import numpy as np
-from scipy.optimize import minimize
+from scipy import sparse
+from scipy.optimize import linprog, minimize
 
 
+def calc_returns(df, tickers):
+    """
+    Calculate the daily returns for the given tickers.
+
+    Parameters:
+    df (pd.DataFrame): DataFrame containing columns 'date', 'ticker', and 'adjClose'.
+    tickers (list): List of tickers to include in the calculation.
+
+    Returns:
+    returns (pd.DataFrame): Daily returns indexed by date, one column per ticker.
+    """
+
+    filtered_df = df[df['ticker'].isin(tickers)].copy()
+    filtered_df['date'] = pd.to_datetime(filtered_df['date'])
+    pivot_df = filtered_df.pivot(index='date', columns='ticker', values='adjClose')
+    returns = pivot_df.pct_change().dropna()
+
+    return returns
+
 def calc_returns_cov(df, tickers):
     """
     Calculate the expected daily returns and the covariance matrix for the given tickers.
@@ -16,10 +36,7 @@ def calc_returns_cov(df, tickers):
     cov_matrix (pd.DataFrame): The covariance matrix of daily returns for the tickers.
     """
     
-    filtered_df = df[df['ticker'].isin(tickers)].copy()
-    filtered_df['date'] = pd.to_datetime(filtered_df['date'])
-    pivot_df = filtered_df.pivot(index='date', columns='ticker', values='adjClose')
-    returns = pivot_df.pct_change().dropna()
+    returns = calc_returns(df, tickers)
     expected_returns = returns.mean()
     
     # Calculate the covariance matrix of daily returns, need to be refined with better factor models
@@ -48,25 +65,390 @@ def portfolio_returns_std(weights, expected_returns, cov_matrix):
     
     return annual_returns, annual_std_dev
 
-def optimize_portfolio(expected_returns, cov_matrix, weighted_scores, delta, gamma, target_risk, risk_free_rate, long_only=False):
+def _matrix_sqrt(cov_matrix):
+    """
+    Return L such that L @ L.T == cov_matrix, falling back to an eigen decomposition
+    when the sample covariance is not strictly positive definite (e.g. few observations).
+    """
+
+    try:
+        return np.linalg.cholesky(cov_matrix)
+    except np.linalg.LinAlgError:
+        eigvals, eigvecs = np.linalg.eigh(cov_matrix)
+        return eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+
+def _scenario_chunks(returns, n_scenarios, method, nu, tail_scale, chunk_size, rng):
+    """
+    Yield (scenarios, log_weights) chunks of at most chunk_size rows, so the temporary
+    arrays never exceed chunk_size x n_assets regardless of the total number of scenarios.
+    """
+
+    n_obs = len(returns)
+
+    if method == 'historical':
+        for start in range(0, n_obs, chunk_size):
+            chunk = returns[start:start + chunk_size]
+            yield chunk, np.zeros(len(chunk))
+
+    elif method == 'bootstrap':
+        for start in range(0, n_scenarios, chunk_size):
+            size = min(chunk_size, n_scenarios - start)
+            yield returns[rng.integers(0, n_obs, size)], np.zeros(size)
+
+    elif method == 'importance':
+        # Multivariate Student-t with the sample mean and covariance: x = mu + L z sqrt((nu - 2) / W),
+        # W ~ chi2(nu). The mixing variable W is drawn from Gamma(nu / 2, 2 / tail_scale^2) instead,
+        # which stretches every shock by tail_scale and oversamples the tails. The likelihood ratio
+        # p / q ~ exp(W (tail_scale^2 - 1) / 2) only depends on W, not on the number of assets, but its
+        # second moment under q is finite only for tail_scale^2 < 2, hence the bound on tail_scale.
+        mu = returns.mean(axis=0)
+        chol = _matrix_sqrt(np.cov(returns, rowvar=False))
+        for start in range(0, n_scenarios, chunk_size):
+            size = min(chunk_size, n_scenarios - start)
+            z = rng.standard_normal((size, len(mu)))
+            w = rng.gamma(nu / 2, 2 / tail_scale**2, size)
+            chunk = mu + (z @ chol.T) * np.sqrt((nu - 2) / w)[:, None]
+            yield chunk, w * (tail_scale**2 - 1) / 2 - nu * np.log(tail_scale)
+
+    else:
+        raise ValueError(f"Unknown scenario method '{method}', expected 'historical', 'bootstrap' or 'importance'")
+
+def generate_scenarios(returns, n_scenarios=None, method='historical', nu=4.0, tail_scale=1.25,
+                       chunk_size=10_000, dtype=np.float32, seed=None):
+    """
+    Generate a matrix of daily return scenarios and their probabilities for CVaR optimisation.
+
+    Parameters:
+    returns (pd.DataFrame): Daily returns, as produced by calc_returns.
+    n_scenarios (int): Number of scenarios to draw. Ignored for 'historical'.
+    method (str): 'historical' uses the observed returns, 'bootstrap' resamples them with replacement,
+        'importance' draws heavy-tailed Student-t scenarios with importance weights.
+    nu (float): Degrees of freedom of the Student-t, must be greater than 2.
+    tail_scale (float): Factor by which the importance sampler stretches shocks, 1 means plain sampling.
+        Must be in (0, sqrt(2)), above which the importance weights have infinite variance.
+    chunk_size (int): Number of scenarios generated per batch, bounds the temporary memory.
+    dtype (np.dtype): dtype of the scenario matrix, float32 halves the memory of float64.
+    seed (int): Seed for the random number generator.
+
+    Returns:
+    np.ndarray: Scenario matrix of shape (n_scenarios, n_assets), columns ordered as returns.columns.
+    np.ndarray: Probability of each scenario, summing to 1. See effective_sample_size to check
+        how many scenarios the importance weights effectively leave.
+    """
+
+    returns = np.asarray(returns, dtype=np.float64)
+    if method == 'historical':
+        n_scenarios = len(returns)
+    elif n_scenarios is None:
+        raise ValueError(f"n_scenarios is required for method '{method}'")
+    if n_scenarios <= 0:
+        raise ValueError("n_scenarios must be positive")
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    if method == 'importance' and nu <= 2:
+        raise ValueError("nu must be greater than 2 for the covariance to exist")
+    if method == 'importance' and not 0 < tail_scale < np.sqrt(2):
+        raise ValueError("tail_scale must be in (0, sqrt(2)) for the importance weights to have finite variance")
+
+    rng = np.random.default_rng(seed)
+    scenarios = np.empty((n_scenarios, returns.shape[1]), dtype=dtype)
+    log_weights = np.empty(n_scenarios)
+
+    start = 0
+    for chunk, chunk_log_weights in _scenario_chunks(returns, n_scenarios, method, nu, tail_scale, chunk_size, rng):
+        scenarios[start:start + len(chunk)] = chunk
+        log_weights[start:start + len(chunk)] = chunk_log_weights
+        start += len(chunk)
+
+    # Self-normalised weights, shifted by the max before exponentiating to avoid overflow
+    probabilities = np.exp(log_weights - log_weights.max())
+    probabilities /= probabilities.sum()
+
+    return scenarios, probabilities
+
+def effective_sample_size(probabilities):
+    """
+    Calculate Kish's effective sample size 1 / sum(p^2) of the scenario probabilities.
+
+    Parameters:
+    probabilities (np.ndarray): Probability of each scenario, summing to 1.
+
+    Returns:
+    float: Effective number of equally weighted scenarios, equal to the scenario count when uniform.
+    """
+
+    return 1. / np.sum(np.square(probabilities))
+
+def _check_probabilities(scenarios, probabilities):
+    """
+    Return the scenario probabilities as float64, uniform if None, checking they match the scenarios and
+    form a distribution. A sum off by rounding only is normalised away.
+    """
+
+    n_scenarios = len(scenarios)
+    if probabilities is None:
+        return np.full(n_scenarios, 1. / n_scenarios)
+
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    if probabilities.shape != (n_scenarios,):
+        raise ValueError(f"probabilities has shape {probabilities.shape}, expected ({n_scenarios},) to match scenarios")
+    if not np.all(probabilities >= 0):
+        raise ValueError("probabilities must be non-negative")
+    total = probabilities.sum()
+    if not np.isclose(total, 1., rtol=0, atol=1e-6):
+        raise ValueError(f"probabilities must sum to 1, got {total}")
+
+    return probabilities / total
+
+def _cvar_tail(losses, probabilities, beta):
+    """
+    Return the VaR, the CVaR and the tail weights q of the losses, where q_s <= p_s / (1 - beta)
+    puts all the mass on the worst scenarios so that CVaR = q @ losses.
+    """
+
+    tail = 1 - beta
+    order = np.argsort(losses)[::-1]
+    sorted_probabilities = probabilities[order]
+    cum_prob = np.cumsum(sorted_probabilities)
+
+    # The scenario straddling the (1 - beta) boundary only enters with its remaining share
+    sorted_q = np.clip(np.minimum(sorted_probabilities, tail - (cum_prob - sorted_probabilities)), 0, None) / tail
+    q = np.zeros(len(losses))
+    q[order] = sorted_q
+
+    var = losses[order[min(np.searchsorted(cum_prob, tail), len(losses) - 1)]]
+    cvar = np.dot(q, losses)
+
+    return var, cvar, q
+
+def portfolio_cvar(weights, scenarios, probabilities=None, beta=0.95):
+    """
+    Calculate the portfolio's daily Value at Risk and Conditional Value at Risk of losses over scenarios.
+
+    Parameters:
+    weights (np.ndarray): Portfolio weights.
+    scenarios (np.ndarray): Scenario matrix of daily returns.
+    probabilities (np.ndarray): Probability of each scenario, uniform if None.
+    beta (float): Confidence level, e.g. 0.95 for the worst 5% of scenarios.
+
+    Returns:
+    float: Daily portfolio VaR (as a positive loss).
+    float: Daily portfolio CVaR (as a positive loss).
+    """
+
+    if not 0 < beta < 1:
+        raise ValueError("beta must be in (0, 1)")
+    scenarios = np.asarray(scenarios)
+    probabilities = _check_probabilities(scenarios, probabilities)
+
+    losses = -(scenarios @ np.asarray(weights, dtype=scenarios.dtype)).astype(np.float64)
+    var, cvar, _ = _cvar_tail(losses, probabilities, beta)
+
+    return var, cvar
+
+def _tail_scenarios(losses, probabilities, beta):
+    """
+    Return the indices of the scenarios making up the (1 - beta) tail of the losses.
+    """
+
+    if beta <= 0:
+        return np.arange(len(losses))
+    _, _, q = _cvar_tail(losses, probabilities, beta)
+    return np.flatnonzero(q)
+
+def _merge_duplicate_rows(scenarios, active, probabilities, chunk_size=10_000):
+    """
+    Return the distinct active scenario rows with their summed probabilities. Bootstrapped scenarios
+    repeat historical rows, so this shrinks the LP to at most the number of distinct days.
+
+    Rows are grouped by a random projection, far cheaper than np.unique(axis=0) on wide rows, and the
+    grouping is only kept if every row really equals its group's representative. Both passes go by
+    chunks, so only the distinct rows are copied.
+    """
+
+    projection = np.random.default_rng(0).standard_normal(scenarios.shape[1])
+    chunks = [active[start:start + chunk_size] for start in range(0, len(active), chunk_size)]
+    key = np.concatenate([scenarios[chunk].astype(np.float64) @ projection for chunk in chunks])
+    _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+
+    rows = scenarios[active[first]]
+    start = 0
+    for chunk in chunks:
+        if not np.array_equal(scenarios[chunk], rows[inverse[start:start + len(chunk)]]):
+            return scenarios[active], probabilities[active]
+        start += len(chunk)
+
+    return rows, np.bincount(inverse, weights=probabilities[active])
+
+def _min_cvar_weights(reward, scenarios, probabilities, beta, lower, upper, target_return=None, active=None,
+                      max_iter=50):
+    """
+    Minimise CVaR(w) - reward.w, or CVaR(w) s.t. reward.w >= target_return when target_return is given,
+    through the dual of the Rockafellar-Uryasev linear program, generating scenarios as needed.
+
+    The dual has one variable per scenario, the tail weight 0 <= q_s <= p_s / (1 - beta) with sum(q) = 1,
+    and one row per asset, which the HiGHS interior point solver handles much faster than the primal's
+    one row per scenario. With target_return the reward is scaled by theta >= 0, the multiplier of the
+    return constraint. Only the active scenarios near the tail are included; the restricted problem is
+    a relaxation, so once every tail scenario of its optimal weights is active those weights are optimal
+    for the full problem. Each iteration reads the scenario matrix without copying it, only the distinct
+    active rows are copied into the LP.
+
+    Returns the weights, theta (None without target_return) and the scenarios within the margin of the
+    tail, to start the next call from.
+    """
+
+    n_assets = scenarios.shape[1]
+    identity = sparse.identity(n_assets, format='csr')
+    # Keep a margin of twice the tail when adding scenarios, to save iterations
+    margin_beta = 2 * beta - 1
+
+    if active is None:
+        # Start from the tail of the equally weighted portfolio
+        losses = -(scenarios @ np.full(n_assets, 1. / n_assets, dtype=scenarios.dtype)).astype(np.float64)
+        active = _tail_scenarios(losses, probabilities, margin_beta)
+
+    for _ in range(max_iter):
+        rows, row_probabilities = _merge_duplicate_rows(scenarios, active, probabilities)
+        n_active = len(rows)
+
+        # Variables are [q, nu, mu_upper, mu_lower], nu and mu being the duals of sum(w) = 1 and the bounds,
+        # followed by theta with target_return
+        A_eq = [
+            [sparse.csr_matrix(rows.T.astype(np.float64)), sparse.csr_matrix(np.ones((n_assets, 1))), -identity, identity],
+            [sparse.csr_matrix(np.ones((1, n_active))), sparse.csr_matrix((1, 1 + 2 * n_assets))],
+        ]
+        b_eq = np.append(-reward, 1.)
+        c = np.concatenate((np.zeros(n_active), [-1.], upper, -lower))
+
+        if target_return is not None:
+            A_eq[0].append(sparse.csr_matrix(reward[:, None]))
+            A_eq[1].append(sparse.csr_matrix((1, 1)))
+            b_eq[:n_assets] = 0
+            c = np.append(c, -target_return)
+
+        A_eq = sparse.vstack([sparse.hstack(blocks) for blocks in A_eq], format='csr')
+        bounds = np.vstack([
+            np.column_stack((np.zeros(n_active), row_probabilities / (1 - beta))),
+            [(-np.inf, np.inf)],
+            np.tile((0, np.inf), (A_eq.shape[1] - n_active - 1, 1)),
+        ])
+
+        opt_results = linprog(c, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs-ipm')
+        if not opt_results.success:
+            raise ValueError(f"CVaR optimisation failed: {opt_results.message}")
+
+        # The primal weights are the duals of the asset rows
+        weights = np.clip(-opt_results.eqlin.marginals[:n_assets], lower, upper)
+        losses = -(scenarios @ weights.astype(scenarios.dtype)).astype(np.float64)
+        margin = _tail_scenarios(losses, probabilities, margin_beta)
+        is_active = np.zeros(len(scenarios), dtype=bool)
+        is_active[active] = True
+        if is_active[_tail_scenarios(losses, probabilities, beta)].all():
+            return weights, None if target_return is None else opt_results.x[-1], margin
+
+        is_active[margin] = True
+        active = np.flatnonzero(is_active)
+
+    raise ValueError(f"CVaR optimisation did not converge within {max_iter} iterations")
+
+def _optimize_portfolio_cvar(expected_returns, weighted_scores, delta, gamma, risk_aversion, target_risk,
+                             scenarios, probabilities, beta, long_only, tol=1e-6, max_iter=50):
+    """
+    Solve the CVaR problem, either min risk_aversion * CVaR - reward (target_risk None) or
+    max reward s.t. CVaR <= target_risk, all terms being daily.
+
+    The objective is divided by risk_aversion, so that the dual bounds stay p_s / (1 - beta) whatever its
+    scale; a small risk_aversion would otherwise push them below the solver tolerances. The capped problem
+    follows the efficient frontier C(R) = min CVaR s.t. reward >= R, convex and piecewise linear, whose
+    slope is the multiplier theta. Newton steps from the highest reward stay above target_risk by
+    convexity and land on it once on the right segment.
+    """
+
+    n_assets = scenarios.shape[1]
+    probabilities = _check_probabilities(scenarios, probabilities)
+
+    reward = delta * np.asarray(expected_returns, dtype=np.float64) + gamma * np.asarray(weighted_scores, dtype=np.float64)
+    lower, upper = (np.zeros(n_assets), np.ones(n_assets)) if long_only else (-np.ones(n_assets), np.ones(n_assets))
+
+    if target_risk is None and risk_aversion > 0:
+        return _min_cvar_weights(reward / risk_aversion, scenarios, probabilities, beta, lower, upper)[0]
+
+    # Without the CVaR term the problem only depends on the reward
+    opt_results = linprog(-reward, A_eq=np.ones((1, n_assets)), b_eq=[1.], bounds=np.column_stack((lower, upper)),
+                          method='highs')
+    if not opt_results.success:
+        raise ValueError(f"CVaR optimisation failed: {opt_results.message}")
+    if target_risk is None:
+        return opt_results.x
+
+    # Scale the reward so that theta stays of the order of the CVaR
+    if np.abs(reward).max() > 0:
+        reward = reward / np.abs(reward).max()
+    target_return = reward @ opt_results.x
+    active = None
+
+    for _ in range(max_iter):
+        weights, theta, active = _min_cvar_weights(reward, scenarios, probabilities, beta, lower, upper,
+                                                   target_return, active)
+        cvar = portfolio_cvar(weights, scenarios, probabilities, beta)[1]
+        if cvar <= target_risk * (1 + tol):
+            return weights
+        if theta <= 0:
+            raise ValueError(f"CVaR optimisation failed: target_risk {target_risk} is below the lowest achievable CVaR {cvar}")
+        target_return -= (cvar - target_risk) / theta
+
+    raise ValueError(f"CVaR optimisation did not converge within {max_iter} iterations")
+
+def optimize_portfolio(expected_returns, cov_matrix, weighted_scores, delta, gamma, target_risk, risk_free_rate, long_only=False,
+                       risk_measure='variance', scenarios=None, probabilities=None, beta=0.95, risk_aversion=1.0):
     """
     Optimize the portfolio considering the Sharpe ratio and weighted scores for a fixed level of risk.
 
     Parameters:
-    expected_returns (pd.Series): Expected returns for each asset.
-    cov_matrix (pd.DataFrame): Covariance matrix of asset returns.
+    expected_returns (pd.Series): Expected daily returns for each asset.
+    cov_matrix (pd.DataFrame): Covariance matrix of asset returns, unused (may be None) for 'cvar'.
     weighted_scores (pd.Series): Scores indicating preference for long or short positions.
+    delta (float): Weight of the Sharpe ratio for 'variance', of the expected daily return for 'cvar'.
     gamma (float): Weight indicating preference for weighted_scores.
-    target_risk (float): Target risk level for the portfolio.
+    target_risk (float): Target risk level for the portfolio. Annualised volatility for 'variance',
+        upper bound on the daily CVaR of losses for 'cvar', where None minimises
+        risk_aversion * CVaR - delta * daily return - gamma * scores instead.
     risk_free_rate (float): Risk-free rate for calculating Sharpe ratio.
+    risk_measure (str): 'variance' maximises the Sharpe ratio at target volatility, 'cvar' solves the
+        Rockafellar-Uryasev CVaR linear program over the scenarios through its dual.
+    scenarios (np.ndarray): Scenario matrix of daily returns from generate_scenarios, required for 'cvar'.
+        Never copied whole; the LP grows with the distinct tail scenarios.
+    probabilities (np.ndarray): Probability of each scenario, uniform if None.
+    beta (float): CVaR confidence level.
+    risk_aversion (float): Weight of the daily CVaR when target_risk is None for 'cvar'.
 
     Returns:
     np.ndarray: Optimal weights for the portfolio.
-    float: Expected portfolio return.
-    float: Expected portfolio volatility.
-    float: Portfolio Sharpe ratio.
+    float: Expected annual portfolio return.
+    float: Portfolio risk, annualised volatility for 'variance', daily CVaR of losses for 'cvar'.
+    float: Risk-adjusted return, the Sharpe ratio for 'variance', the daily excess return over the
+        daily CVaR (STARR ratio) for 'cvar', nan when the CVaR is not a positive loss.
     """
     
+    if risk_measure == 'cvar':
+        if scenarios is None:
+            raise ValueError("scenarios are required for risk_measure='cvar'")
+        scenarios = np.asarray(scenarios)
+        if not 0 < beta < 1:
+            raise ValueError("beta must be in (0, 1)")
+        optimal_weights = _optimize_portfolio_cvar(
+            expected_returns, weighted_scores, delta, gamma, risk_aversion, target_risk,
+            scenarios, probabilities, beta, long_only
+        )
+        annual_returns = np.dot(optimal_weights, expected_returns) * 252
+        _, cvar = portfolio_cvar(optimal_weights, scenarios, probabilities, beta)
+        # A CVaR of zero or below means the tail still gains, where the ratio has no meaning
+        starr_ratio = (annual_returns - risk_free_rate) / 252 / cvar if cvar > 0 else np.nan
+        return optimal_weights, annual_returns, cvar, starr_ratio
+    elif risk_measure != 'variance':
+        raise ValueError(f"Unknown risk_measure '{risk_measure}', expected 'variance' or 'cvar'")
+
     def objective_function(weights, expected_returns, cov_matrix, weighted_scores, risk_free_rate):
         annual_returns, annual_std_dev = portfolio_returns_std(weights, expected_returns, cov_matrix)
         sharpe_ratio = (annual_returns - risk_free_rate) / annual_std_dev